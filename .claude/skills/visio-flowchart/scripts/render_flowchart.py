@@ -6,6 +6,7 @@ Renders Mermaid flowchart (graph TB) notation as PNG images with Visio-like styl
 
 import re
 import argparse
+import functools
 from typing import List, Dict, Tuple, Optional
 from dataclasses import dataclass
 from enum import Enum
@@ -45,6 +46,34 @@ BOX_MARGIN = 20
 SUBGRAPH_MARGIN = 30
 ARROW_SPACING = 40
 
+# Scaled layout constants (pixels in the rendered image)
+SCALED_BOX_WIDTH = int(BOX_WIDTH * SCALE)
+SCALED_BOX_HEIGHT = int(BOX_HEIGHT * SCALE)
+SCALED_FONT_SIZE_BOX = int(FONT_SIZE_BOX * SCALE)
+SCALED_LINE_STEP = SCALED_FONT_SIZE_BOX + 2
+SCALED_HEADER_HEIGHT = int(30 * SCALE)
+
+# Arrow endpoint offsets (start_x, start_y, end_x, end_y) from the source/target
+# box origins, keyed by horizontal direction
+_ARROW_ENDPOINT_OFFSETS = {
+    1: (BOX_WIDTH, BOX_HEIGHT // 2, -5, 0),  # Left to right
+    -1: (-5, BOX_HEIGHT // 2, BOX_WIDTH, 0),  # Right to left
+    0: (BOX_WIDTH // 2, BOX_HEIGHT, BOX_WIDTH // 2, -5),  # Vertical
+}
+
+# Arrow head offsets (ax1, ay1, ax2, ay2) from the tip of a vertical arrow
+_VERTICAL_ARROW_HEAD = {
+    1: (-5, -7, 5, -7),  # Downward
+    -1: (5, 7, -5, 7),  # Upward
+}
+
+# Mermaid syntax patterns
+_SUBGRAPH_RE = re.compile(r'subgraph\s+(\[?["\']?([^"\"\]]+)["\']?\]?)')
+_NODE_RE = re.compile(r'(\w+)\[([^\]]+)\]')
+_EDGE_RE = re.compile(r'(\w+)\s*-->\s*(?:\|([^|]+)\|\s*)?(\w+)')
+_STYLE_RE = re.compile(r'style\s+(\w+)\s+fill:(#[\da-fA-F]+)')
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+
 
 class LayerType(Enum):
     PRESENTATION = "presentation"
@@ -55,12 +84,16 @@ class LayerType(Enum):
     OTHER = "other"
 
 
-@dataclass
+@dataclass(slots=True)
 class Node:
     id: str
     label: str
     layer: Optional[str] = None
     layer_type: LayerType = LayerType.OTHER
+    x: int = 0
+    y: int = 0
+    sx: int = 0
+    sy: int = 0
 
 
 @dataclass
@@ -70,7 +103,7 @@ class Edge:
     label: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Subgraph:
     id: str
     label: str
@@ -102,6 +135,18 @@ def detect_layer_type(label: str) -> LayerType:
     return LayerType.OTHER
 
 
+@functools.lru_cache(maxsize=8)
+def _get_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """Load a TrueType font, reusing previously loaded instances."""
+    return ImageFont.truetype(path, size)
+
+
+@functools.lru_cache(maxsize=4096)
+def _text_width(text: str, font: ImageFont.ImageFont) -> int:
+    """Measure the advance width of a single line of text."""
+    return round(font.getlength(text))
+
+
 def get_layer_color(layer_type: LayerType) -> str:
     """Get background color for layer type."""
     colors = {
@@ -115,31 +160,30 @@ def get_layer_color(layer_type: LayerType) -> str:
     return colors.get(layer_type, BOX_BG_COLOR)
 
 
-def parse_mermaid(content: str) -> Tuple[List[Subgraph], List[Node], List[Edge]]:
+def parse_mermaid(content: str) -> Tuple[Dict[str, Subgraph], Dict[str, Node], List[Edge]]:
     """Parse Mermaid graph TB notation."""
-    lines = content.strip().split('\n')
+    lines = [s for s in (raw.strip() for raw in content.splitlines()) if s and not s.startswith('%%')]
 
     subgraphs: Dict[str, Subgraph] = {}
     nodes: Dict[str, Node] = {}
     edges: List[Edge] = []
+    edges_append = edges.append
 
     current_subgraph = None
+    subgraph_nodes_append = None
     in_subgraph = False
 
     for line in lines:
-        line = line.strip()
-        if not line or line.startswith('%%'):
-            continue
-
         # Subgraph start
         if line.startswith('subgraph'):
-            match = re.match(r'subgraph\s+(\[?["\']?([^"\"\]]+)["\']?\]?)', line)
+            match = _SUBGRAPH_RE.match(line)
             if match:
                 sg_id = match.group(1).strip('[]')
                 sg_label = match.group(2) if len(match.groups()) > 1 else sg_id
                 layer_type = detect_layer_type(sg_label)
                 current_subgraph = Subgraph(id=sg_id, label=sg_label, layer_type=layer_type)
                 subgraphs[sg_id] = current_subgraph
+                subgraph_nodes_append = current_subgraph.nodes.append
                 in_subgraph = True
             continue
 
@@ -147,69 +191,60 @@ def parse_mermaid(content: str) -> Tuple[List[Subgraph], List[Node], List[Edge]]
         if line == 'end':
             in_subgraph = False
             current_subgraph = None
+            subgraph_nodes_append = None
             continue
 
+        # Style directive (for node styles)
+        if line.startswith('style'):
+            style_match = _STYLE_RE.match(line)
+            if style_match:
+                node_id = style_match.group(1)
+                fill_color = style_match.group(2)
+                if node_id in subgraphs:
+                    # For subgraphs, we could apply custom color if needed
+                    pass
+                elif node_id in nodes:
+                    # Could apply node-specific colors here
+                    pass
+                continue
+
         # Node definition
-        node_match = re.match(r'(\w+)\[([^\]]+)\]', line)
+        node_match = _NODE_RE.match(line)
         if node_match:
             node_id = node_match.group(1)
             # Handle HTML-like labels (e.g., <br/>)
             label = node_match.group(2).replace('<br/>', '\n').replace('<br>', '\n')
-            label = re.sub(r'<[^>]+>', '', label)  # Remove other HTML tags
+            label = _HTML_TAG_RE.sub('', label)  # Remove other HTML tags
 
             node = Node(id=node_id, label=label)
             if current_subgraph:
                 node.layer = current_subgraph.id
                 node.layer_type = current_subgraph.layer_type
-                current_subgraph.nodes.append(node)
+                subgraph_nodes_append(node)
             nodes[node_id] = node
             continue
 
         # Edge definition with optional label
-        edge_match = re.match(r'(\w+)\s*-->\s*(\|[^|]+\|)?\s*(\w+)', line)
+        edge_match = _EDGE_RE.match(line)
         if edge_match:
             from_id = edge_match.group(1)
             label_text = edge_match.group(2)
             to_id = edge_match.group(3)
 
-            if label_text:
-                label_text = label_text.strip('|')
-
-            if from_id in nodes and to_id in nodes:
-                edges.append(Edge(from_id=from_id, to_id=to_id, label=label_text))
-            continue
-
-        # Simple edge (no label)
-        simple_edge = re.match(r'(\w+)\s*-->\s*(\w+)', line)
-        if simple_edge:
-            from_id = simple_edge.group(1)
-            to_id = simple_edge.group(2)
             if from_id in nodes and to_id in nodes:
-                edges.append(Edge(from_id=from_id, to_id=to_id))
-
-    # Style directive parsing (for node styles)
-    for line in lines:
-        style_match = re.match(r'style\s+(\w+)\s+fill:(#[\da-fA-F]+)', line)
-        if style_match:
-            node_id = style_match.group(1)
-            fill_color = style_match.group(2)
-            if node_id in subgraphs:
-                # For subgraphs, we could apply custom color if needed
-                pass
-            elif node_id in nodes:
-                # Could apply node-specific colors here
-                pass
+                edges_append(Edge(from_id=from_id, to_id=to_id, label=label_text))
 
-    return list(subgraphs.values()), list(nodes.values()), edges
+    return subgraphs, nodes, edges
 
 
-def calculate_layout(subgraphs: List[Subgraph], nodes: List[Node], edges: List[Edge]) -> Tuple[int, int]:
+def calculate_layout(subgraphs: Dict[str, Subgraph], nodes: Dict[str, Node], edges: List[Edge]) -> Tuple[int, int]:
     """Calculate layout positions for all elements."""
     x_offset = SUBGRAPH_MARGIN
     y_offset = SUBGRAPH_MARGIN
+    bottom = 0
 
     # Position subgraphs horizontally
-    for sg in subgraphs:
+    for sg in subgraphs.values():
         # Calculate subgraph dimensions based on nodes
         if sg.nodes:
             sg.height = len(sg.nodes) * (BOX_HEIGHT + BOX_MARGIN) + BOX_MARGIN * 2 + 30
@@ -221,40 +256,46 @@ def calculate_layout(subgraphs: List[Subgraph], nodes: List[Node], edges: List[E
         sg.x = x_offset
         sg.y = y_offset
         x_offset += sg.width + SUBGRAPH_MARGIN
+        bottom = max(bottom, sg.y + sg.height)
 
-    # Position nodes within subgraphs
-    for sg in subgraphs:
+    # Position nodes within subgraphs (always inside the subgraph bounds)
+    right = x_offset
+    for sg in subgraphs.values():
+        node_x = sg.x + BOX_MARGIN
+        node_sx = int(node_x * SCALE)
         node_y = sg.y + 40  # Space for header
         for node in sg.nodes:
-            node.x = sg.x + BOX_MARGIN
+            node.x = node_x
             node.y = node_y
+            node.sx = node_sx
+            node.sy = int(node_y * SCALE)
             node_y += BOX_HEIGHT + BOX_MARGIN
 
     # Position nodes not in any subgraph
-    orphan_nodes = [n for n in nodes if not any(n.id in [node.id for node in sg.nodes] for sg in subgraphs)]
+    subgraph_node_ids = {node.id for sg in subgraphs.values() for node in sg.nodes}
+    orphan_nodes = [n for n in nodes.values() if n.id not in subgraph_node_ids]
     if orphan_nodes:
         orphan_x = x_offset
+        orphan_sx = int(orphan_x * SCALE)
         orphan_y = y_offset
         for node in orphan_nodes:
             node.x = orphan_x
             node.y = orphan_y
+            node.sx = orphan_sx
+            node.sy = int(orphan_y * SCALE)
             orphan_y += BOX_HEIGHT + BOX_MARGIN
+        right = orphan_x + BOX_WIDTH
+        bottom = max(bottom, orphan_y - BOX_MARGIN)
 
     # Calculate total canvas size
-    total_width = max(
-        x_offset,
-        max((n.x + BOX_WIDTH for n in nodes), default=x_offset)
-    ) + SUBGRAPH_MARGIN
-
-    total_height = max(
-        max((sg.y + sg.height for sg in subgraphs), default=0),
-        max((n.y + BOX_HEIGHT for n in nodes), default=0)
-    ) + SUBGRAPH_MARGIN
+    total_width = right + SUBGRAPH_MARGIN
+    total_height = bottom + SUBGRAPH_MARGIN
 
     return total_width, total_height
 
 
-def draw_arrow(draw: ImageDraw.Draw, from_x: int, from_y: int, to_x: int, to_y: int, label: Optional[str] = None):
+def draw_arrow(draw: ImageDraw.Draw, from_x: int, from_y: int, to_x: int, to_y: int, label: Optional[str] = None,
+               label_font: Optional[ImageFont.ImageFont] = None):
     """Draw an arrow between two points."""
     color = ARROW_COLOR
 
@@ -264,40 +305,33 @@ def draw_arrow(draw: ImageDraw.Draw, from_x: int, from_y: int, to_x: int, to_y:
 
     dx = to_x - from_x
     dy = to_y - from_y
-    length = (dx * dx + dy * dy) ** 0.5
 
-    if length == 0:
+    if dx == 0 and dy == 0:
         return
 
-    # Unit vector
-    ux = dx / length
-    uy = dy / length
-
-    # Adjust end point to box edge
-    if from_x < to_x:  # Left to right
-        end_x = to_x - 5
-        end_y = to_y
-        start_x = from_x + BOX_WIDTH
-        start_y = from_y + BOX_HEIGHT // 2
-    elif from_x > to_x:  # Right to left
-        end_x = to_x + BOX_WIDTH
-        end_y = to_y
-        start_x = from_x - 5
-        start_y = from_y + BOX_HEIGHT // 2
-    else:  # Vertical
-        end_x = to_x + BOX_WIDTH // 2
-        end_y = to_y - 5
-        start_x = from_x + BOX_WIDTH // 2
-        start_y = from_y + BOX_HEIGHT
+    # Adjust end points to box edges
+    osx, osy, oex, oey = _ARROW_ENDPOINT_OFFSETS[(dx > 0) - (dx < 0)]
+    start_x, start_y = from_x + osx, from_y + osy
+    end_x, end_y = to_x + oex, to_y + oey
 
     # Draw line
     draw.line([(start_x, start_y), (end_x, end_y)], fill=color, width=2)
 
     # Draw arrow head
-    ax1 = end_x - head_length * ux * 0.7 - head_length * uy * 0.5
-    ay1 = end_y - head_length * uy * 0.7 + head_length * ux * 0.5
-    ax2 = end_x - head_length * ux * 0.7 + head_length * uy * 0.5
-    ay2 = end_y - head_length * uy * 0.7 - head_length * ux * 0.5
+    if dx == 0:
+        ox1, oy1, ox2, oy2 = _VERTICAL_ARROW_HEAD[1 if dy > 0 else -1]
+        ax1, ay1 = end_x + ox1, end_y + oy1
+        ax2, ay2 = end_x + ox2, end_y + oy2
+    else:
+        # Unit vector
+        length = (dx * dx + dy * dy) ** 0.5
+        ux = dx / length
+        uy = dy / length
+
+        ax1 = end_x - head_length * ux * 0.7 - head_length * uy * 0.5
+        ay1 = end_y - head_length * uy * 0.7 + head_length * ux * 0.5
+        ax2 = end_x - head_length * ux * 0.7 + head_length * uy * 0.5
+        ay2 = end_y - head_length * uy * 0.7 - head_length * ux * 0.5
 
     draw.polygon([(end_x, end_y), (ax1, ay1), (ax2, ay2)], fill=color)
 
@@ -307,10 +341,7 @@ def draw_arrow(draw: ImageDraw.Draw, from_x: int, from_y: int, to_x: int, to_y:
         mid_y = (start_y + end_y) // 2
 
         # Draw label background
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", int(FONT_SIZE_LABEL * SCALE))
-        except:
-            font = ImageFont.load_default()
+        font = label_font or ImageFont.load_default()
 
         bbox = draw.textbbox((0, 0), label, font=font)
         text_width = bbox[2] - bbox[0]
@@ -340,15 +371,18 @@ def render_flowchart(content: str, title: str = "Flowchart") -> Image.Image:
 
     # Try to load fonts
     try:
-        header_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", int(FONT_SIZE_HEADER * SCALE))
-        box_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", int(FONT_SIZE_BOX * SCALE))
+        header_font = _get_font("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", int(FONT_SIZE_HEADER * SCALE))
+        box_font = _get_font("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", int(FONT_SIZE_BOX * SCALE))
+        label_font = _get_font("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", int(FONT_SIZE_LABEL * SCALE))
     except:
         try:
-            header_font = ImageFont.truetype("DejaVuSans-Bold.ttf", int(FONT_SIZE_HEADER * SCALE))
-            box_font = ImageFont.truetype("DejaVuSans.ttf", int(FONT_SIZE_BOX * SCALE))
+            header_font = _get_font("DejaVuSans-Bold.ttf", int(FONT_SIZE_HEADER * SCALE))
+            box_font = _get_font("DejaVuSans.ttf", int(FONT_SIZE_BOX * SCALE))
+            label_font = _get_font("DejaVuSans.ttf", int(FONT_SIZE_LABEL * SCALE))
         except:
             header_font = ImageFont.load_default()
             box_font = ImageFont.load_default()
+            label_font = ImageFont.load_default()
 
     # Draw title
     if title:
@@ -360,7 +394,7 @@ def render_flowchart(content: str, title: str = "Flowchart") -> Image.Image:
         title_height = 10
 
     # Draw subgraphs
-    for sg in subgraphs:
+    for sg in subgraphs.values():
         x = int(sg.x * SCALE)
         y = int(sg.y * SCALE) + title_height
         w = int(sg.width * SCALE)
@@ -372,71 +406,45 @@ def render_flowchart(content: str, title: str = "Flowchart") -> Image.Image:
         draw.rectangle([x, y, x + w, y + h], fill=bg_color, outline=LANE_BORDER_COLOR, width=2)
 
         # Draw header
-        header_height = int(30 * SCALE)
-        draw.rectangle([x, y, x + w, y + header_height], fill=HEADER_BG_COLOR)
+        draw.rectangle([x, y, x + w, y + SCALED_HEADER_HEIGHT], fill=HEADER_BG_COLOR)
 
         # Draw header text
-        header_bbox = draw.textbbox((0, 0), sg.label, font=header_font)
-        header_text_width = header_bbox[2] - header_bbox[0]
+        header_text_width = _text_width(sg.label, header_font)
         draw.text((x + (w - header_text_width) // 2, y + 5), sg.label, fill=HEADER_TEXT_COLOR, font=header_font)
 
     # Draw nodes
-    for node in nodes:
-        if node.layer:
-            continue  # Skip nodes in subgraphs (they'll be drawn within)
-        x = int(node.x * SCALE)
-        y = int(node.y * SCALE) + title_height
-        w = int(BOX_WIDTH * SCALE)
-        h = int(BOX_HEIGHT * SCALE)
+    for node in nodes.values():
+        x = node.sx
+        y = node.sy + title_height
+        w = SCALED_BOX_WIDTH
+        h = SCALED_BOX_HEIGHT
 
         # Draw rounded rectangle
         draw.rounded_rectangle([x, y, x + w, y + h], radius=8, fill=BOX_BG_COLOR, outline=BOX_BORDER_COLOR, width=2)
 
         # Draw text
         lines = node.label.split('\n')
-        text_y = y + (h - len(lines) * int(FONT_SIZE_BOX * SCALE)) // 2
+        text_y = y + (h - len(lines) * SCALED_FONT_SIZE_BOX) // 2
 
         for line in lines:
-            bbox = draw.textbbox((0, 0), line, font=box_font)
-            text_width = bbox[2] - bbox[0]
+            text_width = _text_width(line, box_font)
             draw.text((x + (w - text_width) // 2, text_y), line, fill=TEXT_COLOR, font=box_font)
-            text_y += int(FONT_SIZE_BOX * SCALE) + 2
-
-    # Draw nodes within subgraphs
-    for sg in subgraphs:
-        sg_y = int(sg.y * SCALE) + title_height
-        for node in sg.nodes:
-            x = int(node.x * SCALE)
-            y = int(node.y * SCALE) + title_height
-            w = int(BOX_WIDTH * SCALE)
-            h = int(BOX_HEIGHT * SCALE)
-
-            # Draw rounded rectangle
-            draw.rounded_rectangle([x, y, x + w, y + h], radius=8, fill=BOX_BG_COLOR, outline=BOX_BORDER_COLOR, width=2)
-
-            # Draw text
-            lines = node.label.split('\n')
-            text_y = y + (h - len(lines) * int(FONT_SIZE_BOX * SCALE)) // 2
-
-            for line in lines:
-                bbox = draw.textbbox((0, 0), line, font=box_font)
-                text_width = bbox[2] - bbox[0]
-                draw.text((x + (w - text_width) // 2, text_y), line, fill=TEXT_COLOR, font=box_font)
-                text_y += int(FONT_SIZE_BOX * SCALE) + 2
+            text_y += SCALED_LINE_STEP
 
     # Draw edges
     for edge in edges:
-        from_node = next((n for n in nodes if n.id == edge.from_id), None)
-        to_node = next((n for n in nodes if n.id == edge.to_id), None)
+        from_node = nodes.get(edge.from_id)
+        to_node = nodes.get(edge.to_id)
 
         if from_node and to_node:
             draw_arrow(
                 draw,
-                int(from_node.x * SCALE),
-                int(from_node.y * SCALE) + title_height,
-                int(to_node.x * SCALE),
-                int(to_node.y * SCALE) + title_height,
-                edge.label
+                from_node.sx,
+                from_node.sy + title_height,
+                to_node.sx,
+                to_node.sy + title_height,
+                edge.label,
+                label_font
             )
 
     return img
@@ -447,6 +455,12 @@ def main():
     parser.add_argument('input', help='Input Mermaid file (.mmd)')
     parser.add_argument('-o', '--output', default='flowchart.png', help='Output PNG file')
     parser.add_argument('-t', '--title', default='Flowchart', help='Chart title')
+    compression = parser.add_mutually_exclusive_group()
+    compression.add_argument('--fast', dest='compress_level', action='store_const', const=1,
+                             help='Fast PNG encoding with larger files (default)')
+    compression.add_argument('--small', dest='compress_level', action='store_const', const=9,
+                             help='Maximum PNG compression for smaller files')
+    parser.set_defaults(compress_level=1)
 
     args = parser.parse_args()
 
@@ -454,7 +468,7 @@ def main():
         content = f.read()
 
     img = render_flowchart(content, args.title)
-    img.save(args.output, 'PNG')
+    img.save(args.output, 'PNG', compress_level=args.compress_level)
     print(f"Flowchart saved to {args.output}")
 
 